@@ -26,7 +26,11 @@ export class RabbitMQService implements OnModuleInit, OnModuleDestroy {
       });
 
       // Declare queues
-      await this.channel.assertQueue("email.queue", { durable: true });
+      // Must match the email service's declaration (x-max-priority: 10)
+      await this.channel.assertQueue("email.queue", {
+        durable: true,
+        maxPriority: 10,
+      });
       await this.channel.assertQueue("push.queue", { durable: true });
       await this.channel.assertQueue("failed.queue", { durable: true });
 
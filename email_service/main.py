@@ -1,30 +1,99 @@
-from fastapi import FastAPI, Depends, HTTPException
-from sqlalchemy.orm import Session
-from uuid import uuid4
-from datetime import datetime
+import os
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Annotated, List
+import orjson
+from fastapi import FastAPI, Body, Depends, HTTPException, Response
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from uuid import UUID
+
+from db import Base, engine, get_db, warm_pool
+from models import EmailMessage, EmailStatus, emails_query, uuid7
+from schemas import EmailCreate, EmailResponse, StandardResponse, StandardBatchResponse
+from task_queue import (
+    setup_queue, open_publisher_pool, close_publisher_pool,
+    publish_email_job_async, publish_email_jobs_async,
+)
+
+
+# Largest number of emails accepted by POST /email/queue/batch
+MAX_BATCH_SIZE = 1000
+
+# Create tables and declare the RabbitMQ topology in every process at startup.
+# Off by default: `python main.py` and start.sh run bootstrap() once instead,
+# so several processes never race on it. Set to 1 for a single bare uvicorn.
+RUN_BOOTSTRAP = os.getenv("RUN_BOOTSTRAP", "0") == "1"
+
+
+def email_json(email: EmailMessage) -> dict:
+    """
+    EmailResponse-shaped dict built straight from the ORM row.
+    """
+    return {
+        "id": str(email.id),
+        "request_id": email.request_id,
+        "user_id": str(email.user_id),
+        "to_email": email.to_email,
+        "subject": email.subject,
+        "status": email.status,
+        "priority": email.priority,
+        "created_at": email.created_at,
+        "sent_at": email.sent_at,
+        "error_message": email.error_message,
+    }
+
+
+def email_job(email: EmailMessage) -> dict:
+    """
+    Queue payload for an email row.
+    """
+    return {
+        "email_id": str(email.id),
+        "to_email": email.to_email,
+        "subject": email.subject,
+        "body": email.body,
+        "priority": email.priority,
+    }
+
+
+def json_response(content: dict, status_code: int = 200) -> Response:
+    """
+    Serialize with orjson and skip FastAPI's response_model re-validation.
+    Only for payloads whose shape is already known to match the model.
+    """
+    return Response(orjson.dumps(content), status_code=status_code, media_type="application/json")
 
-from db import Base, engine, get_db
-from models import EmailMessage, EmailStatus
-from schemas import EmailCreate, EmailResponse, StandardResponse
-from task_queue import setup_queue, publish_email_job
 
+def bootstrap():
+    """
+    Create database tables and the RabbitMQ exchange/queues.
+    """
+    print("[startup] Creating database tables...")
+    Base.metadata.create_all(bind=engine)
 
-print("[startup] Creating database tables...")
-Base.metadata.create_all(bind=engine)
+    print("[startup] Setting up RabbitMQ queue...")
+    setup_queue()
 
 
-print("[startup] Setting up RabbitMQ queue...")
-setup_queue()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if RUN_BOOTSTRAP:
+        await asyncio.to_thread(bootstrap)
+    await asyncio.gather(warm_pool(), asyncio.to_thread(open_publisher_pool))
+    yield
+    await asyncio.to_thread(close_publisher_pool)
 
 
 app = FastAPI(
     title="Email Service",
     description="Simple email notification service",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 @app.get("/health")
-def health_check():
+async def health_check():
     """
     Health check endpoint - returns OK if service is running.
     """
@@ -34,7 +103,7 @@ def health_check():
     }
 
 @app.post("/email/queue", response_model=StandardResponse, status_code=201)
-def queue_email(email: EmailCreate, db: Session = Depends(get_db)):
+async def queue_email(email: EmailCreate, db: AsyncSession = Depends(get_db)):
     """
     Queue a new email for sending.
     
@@ -46,61 +115,165 @@ def queue_email(email: EmailCreate, db: Session = Depends(get_db)):
     The worker will pick it up and actually send it.
     """
     try:
-        # Create new email record
-        new_email = EmailMessage(
-            id=uuid4(),
-            user_id=email.user_id,
-            to_email=str(email.to_email),
-            subject=email.subject,
-            body=email.body,
-            status=EmailStatus.queued,
-            created_at=datetime.utcnow()
+        # Insert the email in one round-trip; a replayed request_id inserts nothing
+        result = await db.execute(
+            insert(EmailMessage)
+            .values(
+                id=uuid7(),
+                request_id=email.request_id,
+                user_id=email.user_id,
+                to_email=email.to_email,
+                subject=email.subject,
+                body=email.body,
+                priority=email.priority,
+                status=EmailStatus.queued
+            )
+            .on_conflict_do_nothing(index_elements=["request_id"])
+            .returning(EmailMessage)
         )
+        new_email = result.scalar_one_or_none()
+
+        if new_email is None:
+            # Duplicate request: hand back the email it already created
+            result = await db.execute(
+                emails_query().where(EmailMessage.request_id == email.request_id)
+            )
+            existing = result.scalar_one()
 
-        db.add(new_email)
-        db.commit()
-        db.refresh(new_email)
+            # The first attempt may have committed and then failed to publish.
+            # Publish again while it is still queued; the worker skips rows that
+            # are already sent or locked by another delivery, so a second copy
+            # of the job cannot send it twice.
+            if existing.status == EmailStatus.queued:
+                await publish_email_job_async(
+                    email_job(existing), priority=existing.priority
+                )
 
-        print(f"[api] Email saved to DB: {new_email.id}")
+            return StandardResponse(
+                success=True,
+                data=EmailResponse.model_validate(existing),
+                message="Email already queued"
+            )
+
+        await db.commit()
 
         # Publish to queue
-        publish_email_job({
-            "email_id": str(new_email.id),
-            "to_email": new_email.to_email,
-            "subject": new_email.subject,
-            "body": new_email.body
-        })
+        await publish_email_job_async(email_job(new_email), priority=new_email.priority)
 
         # Return response based on DB object (not request object!)
-        return StandardResponse(
-            success=True,
-            data=EmailResponse.model_validate(new_email, from_attributes=True),
-            message="Email queued successfully"
-        )
+        return json_response({
+            "success": True,
+            "data": email_json(new_email),
+            "error": None,
+            "message": "Email queued successfully"
+        }, status_code=201)
 
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         print(f"[api] Error queueing email: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
     
     
+@app.post("/email/queue/batch", response_model=StandardBatchResponse, status_code=201)
+async def queue_email_batch(
+    emails: Annotated[List[EmailCreate], Body(min_length=1, max_length=MAX_BATCH_SIZE)],
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Queue many emails at once.
+
+    All rows are written with a single multi-row INSERT and published with a
+    single broker acknowledgement. Emails whose request_id was already used
+    are returned as they are, and published again only if still queued.
+    """
+    try:
+        rows = [
+            {
+                "id": uuid7(),
+                "request_id": email.request_id,
+                "user_id": email.user_id,
+                "to_email": email.to_email,
+                "subject": email.subject,
+                "body": email.body,
+                "priority": email.priority,
+                "status": EmailStatus.queued,
+            }
+            for email in emails
+        ]
+
+        result = await db.execute(
+            insert(EmailMessage)
+            .on_conflict_do_nothing(index_elements=["request_id"])
+            .returning(EmailMessage),
+            rows
+        )
+        new_emails = result.scalars().all()
+
+        # Replayed request_ids inserted nothing; look up what they created before.
+        # A request_id repeated within this batch was inserted by its first row,
+        # so it is neither looked up nor returned twice.
+        inserted_request_ids = {e.request_id for e in new_emails}
+        replayed = list(dict.fromkeys(
+            row["request_id"] for row in rows
+            if row["request_id"] is not None and row["request_id"] not in inserted_request_ids
+        ))
+        existing = []
+        if replayed:
+            result = await db.execute(
+                emails_query().where(EmailMessage.request_id.in_(replayed))
+            )
+            existing = result.scalars().all()
+
+        await db.commit()
+
+        # Replays still queued may have missed their publish; send them again
+        to_publish = [
+            *new_emails, *(e for e in existing if e.status == EmailStatus.queued)
+        ]
+        if to_publish:
+            await publish_email_jobs_async([email_job(e) for e in to_publish])
+
+        return json_response({
+            "success": True,
+            "data": [email_json(e) for e in [*new_emails, *existing]],
+            "error": None,
+            "message": f"{len(new_emails)} email(s) queued successfully"
+        }, status_code=201)
+
+    except Exception as e:
+        await db.rollback()
+        print(f"[api] Error queueing email batch: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.get("/email/{email_id}", response_model=StandardResponse)
-def get_email_status(email_id: str, db: Session = Depends(get_db)):
+async def get_email_status(email_id: UUID, db: AsyncSession = Depends(get_db)):
     """
     Get the status of an email by its ID.
     """
-    email = db.query(EmailMessage).filter(EmailMessage.id == email_id).first()
+    result = await db.execute(emails_query().where(EmailMessage.id == email_id))
+    email = result.scalar_one_or_none()
     
     if not email:
         raise HTTPException(status_code=404, detail="Email not found")
     
     return StandardResponse(
         success=True,
-        data = EmailResponse.model_validate(email, from_attributes=True)
-,
+        data=EmailResponse.model_validate(email),
         message="Email found"
     )
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+
+    # Once here, before the worker processes start
+    bootstrap()
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        access_log=False,
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+    )
\ No newline at end of file
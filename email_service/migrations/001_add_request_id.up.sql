@@ -0,0 +1,5 @@
+-- Idempotency key for POST /email/queue.
+-- New databases get this from Base.metadata.create_all; run this on existing ones.
+ALTER TABLE email_messages ADD COLUMN IF NOT EXISTS request_id VARCHAR(255);
+
+CREATE UNIQUE INDEX IF NOT EXISTS ix_email_messages_request_id ON email_messages(request_id);
@@ -0,0 +1,7 @@
+-- Composite and partial indexes for status/user listings and retry sweeps.
+-- New databases get these from Base.metadata.create_all; run this on existing ones.
+CREATE INDEX IF NOT EXISTS ix_email_status_created ON email_messages(status, created_at);
+
+CREATE INDEX IF NOT EXISTS ix_email_user_created ON email_messages(user_id, created_at DESC);
+
+CREATE INDEX IF NOT EXISTS ix_email_queued ON email_messages(created_at) WHERE status IN ('queued', 'failed');
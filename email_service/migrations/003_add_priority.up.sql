@@ -0,0 +1,3 @@
+-- Message priority for email.queue (0-9, higher is sent first).
+-- New databases get this from Base.metadata.create_all; run this on existing ones.
+ALTER TABLE email_messages ADD COLUMN IF NOT EXISTS priority SMALLINT NOT NULL DEFAULT 0;
@@ -0,0 +1,3 @@
+-- created_at is filled in by Postgres (UTC) instead of by the service.
+-- New databases get this from Base.metadata.create_all; run this on existing ones.
+ALTER TABLE email_messages ALTER COLUMN created_at SET DEFAULT timezone('utc', now());
@@ -1,10 +1,33 @@
+import os
 import enum
-from uuid import uuid4
-from datetime import datetime
-from sqlalchemy import Column, String, Text, Enum, DateTime
+import time
+import uuid
+from sqlalchemy import Column, String, Text, Enum, DateTime, SmallInteger, Index, func, select
+from sqlalchemy.orm import raiseload
 from sqlalchemy.dialects.postgresql import UUID
 from db import Base
 
+def utc_now():
+    """
+    SQL for the current UTC wall-clock time as a naive timestamp.
+
+    Uses clock_timestamp() rather than now(), which is frozen at the start
+    of the transaction.
+    """
+    return func.timezone("utc", func.clock_timestamp())
+
+
+def uuid7() -> uuid.UUID:
+    """
+    Time-ordered UUID (RFC 9562 version 7): a 48-bit Unix millisecond
+    timestamp followed by random bits, so new rows append to the right-hand
+    edge of the primary key index instead of landing on random pages.
+    """
+    value = (time.time_ns() // 1_000_000) << 80 | int.from_bytes(os.urandom(10), "big")
+    value = value & ~(0xF << 76) | 0x7 << 76  # version 7
+    value = value & ~(0x3 << 62) | 0x2 << 62  # RFC 4122 variant
+    return uuid.UUID(int=value)
+
 class EmailStatus(str, enum.Enum):
     """Email status enum"""
     queued = "queued"
@@ -18,7 +41,10 @@ class EmailMessage(Base):
     """
     __tablename__ = "email_messages"
 
-    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid4)
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid7)
+
+    # Caller-supplied idempotency key; replays of the same key return the original email
+    request_id = Column(String(255), nullable=True, unique=True, index=True)
     
     # Email details
     user_id = Column(UUID(as_uuid=True), nullable=False)
@@ -29,10 +55,38 @@ class EmailMessage(Base):
     # Status tracking
     status = Column(Enum(EmailStatus), default=EmailStatus.queued, nullable=False)
     error_message = Column(Text, nullable=True)
+
+    # RabbitMQ message priority (0-9, higher is sent first)
+    priority = Column(SmallInteger, default=0, server_default="0", nullable=False)
     
     
-    created_at = Column(DateTime, default=datetime.utcnow)
+    # Filled in by Postgres (UTC, like sent_at) so inserts don't send it
+    created_at = Column(DateTime, server_default=func.timezone("utc", func.now()))
     sent_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        # Status dashboards / sweeps: WHERE status = ? ORDER BY created_at
+        Index("ix_email_status_created", status, created_at),
+        # A user's emails, newest first
+        Index("ix_email_user_created", user_id, created_at.desc()),
+        # Retry sweeps only ever look at unfinished emails
+        Index(
+            "ix_email_queued",
+            created_at,
+            postgresql_where=status.in_([EmailStatus.queued, EmailStatus.failed]),
+        ),
+    )
     
     def __repr__(self):
-        return f"<EmailMessage {self.id} - {self.status}>"
\ No newline at end of file
+        return f"<EmailMessage {self.id} - {self.status}>"
+
+
+def emails_query():
+    """
+    SELECT for EmailMessage rows that refuses lazy relationship loads.
+
+    Any relationship an endpoint needs must be loaded explicitly (e.g. with
+    selectinload), so an accidental N+1 raises instead of quietly issuing a
+    query per row.
+    """
+    return select(EmailMessage).options(raiseload("*"))
@@ -1,7 +1,11 @@
-from pydantic import BaseModel, EmailStr
+import re
+from pydantic import BaseModel, ConfigDict, Field, field_validator
 from uuid import UUID
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional
+
+# Cheap shape check for addresses; callers are trusted internal services
+_EMAIL_RE = re.compile(r"[^@\s]+@[^@\s]+\.[^@\s]+")
 
 class EmailCreate(BaseModel):
     """
@@ -9,35 +13,48 @@ class EmailCreate(BaseModel):
     This is what the API Gateway will send to us.
     """
     user_id: UUID
-    to_email: EmailStr
+    to_email: str
     subject: str
     body: str
-    
-    class Config:
-        json_schema_extra = {
+    request_id: Optional[str] = Field(default=None, max_length=255)
+    # 0-9; use a high priority for transactional mail such as password resets
+    priority: int = Field(default=0, ge=0, le=9)
+
+    @field_validator("to_email")
+    @classmethod
+    def check_to_email(cls, value: str) -> str:
+        if not _EMAIL_RE.fullmatch(value):
+            raise ValueError("value is not a valid email address")
+        return value
+
+    model_config = ConfigDict(
+        json_schema_extra={
             "example": {
+                "request_id": "signup-123e4567-welcome",
                 "user_id": "123e4567-e89b-12d3-a456-426614174000",
                 "to_email": "user@example.com",
                 "subject": "Welcome to our app!",
                 "body": "<h1>Welcome!</h1><p>Thanks for signing up.</p>"
             }
         }
+    )
 
 class EmailResponse(BaseModel):
     """
     Response format when returning email info.
     """
     id: UUID
+    request_id: Optional[str] = None
     user_id: UUID
     to_email: str
     subject: str
     status: str
+    priority: int = 0
     created_at: datetime
     sent_at: Optional[datetime] = None
     error_message: Optional[str] = None
-    
-    class Config:
-        from_attributes = True
+
+    model_config = ConfigDict(from_attributes=True)
 
 class StandardResponse(BaseModel):
     """
@@ -46,4 +63,13 @@ class StandardResponse(BaseModel):
     success: bool
     data: Optional[EmailResponse] = None
     error: Optional[str] = None
-    message: str
\ No newline at end of file
+    message: str
+
+class StandardBatchResponse(BaseModel):
+    """
+    API response format for batch requests
+    """
+    success: bool
+    data: List[EmailResponse] = []
+    error: Optional[str] = None
+    message: str
@@ -1,107 +1,278 @@
 import os
-from smtplib import SMTP, SMTP_SSL
+import re
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+import aiosmtplib
 from dotenv import load_dotenv
 
 load_dotenv()
 
-def send_email(to_email: str, subject: str, body: str):
+logger = logging.getLogger(__name__)
+
+# Logged-in SMTP connections kept open per server/account
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "4"))
+
+# Idle connections are NOOP'd this often so the server doesn't drop them
+KEEPALIVE_INTERVAL = 30  # seconds
+
+# Stands in for the recipient in cached, pre-serialized messages
+_TO_PLACEHOLDER = b"%%TO%%"
+# The whole header line, so a placeholder in the subject or body is never touched
+_TO_HEADER = b"\nTo: " + _TO_PLACEHOLDER + b"\n"
+
+# Recipients that can be spliced into a cached message as-is
+_PLAIN_ADDRESS_RE = re.compile(rb"[\x21-\x7e]+")
+
+
+def _smtp_settings():
+    """
+    Read SMTP configuration from the environment.
+    """
+    return {
+        "host": os.getenv("SMTP_HOST", "smtp.gmail.com"),
+        "port": int(os.getenv("SMTP_PORT", "587")),
+        "user": os.getenv("SMTP_USER"),
+        "password": os.getenv("SMTP_PASS"),
+        "use_ssl": os.getenv("SMTP_USE_SSL", "false").lower() == "true",
+        "use_tls": os.getenv("SMTP_USE_TLS", "true").lower() == "true",
+    }
+
+
+def _connection_methods(port: int, use_ssl: bool, use_tls: bool):
+    """
+    Connection methods to try, in order, for the configured port.
+    """
+    if port == 465 or use_ssl:
+        # Port 465 uses SSL/TLS from the start
+        return [("ssl", port)]
+    if port == 587:
+        # Port 587 uses STARTTLS, falling back to SSL if it fails
+        return [("starttls", 587), ("ssl", 465)]
+    # Other ports (e.g., 25)
+    methods = [("starttls", port)]
+    if use_tls:
+        methods.append(("ssl", 465))
+    return methods
+
+
+class SMTPPool:
+    """
+    Pool of authenticated SMTP connections to a single server/account.
+
+    Connections are opened lazily (or up front with `fill`) and reused, so a
+    send costs one MAIL/RCPT/DATA exchange instead of a full connect, TLS
+    handshake and login.
+    """
+
+    def __init__(self, host: str, port: int, user, password, use_ssl: bool, use_tls: bool, size: int):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.use_ssl = use_ssl
+        self.use_tls = use_tls
+        self.size = size
+
+        self._idle: asyncio.Queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(size)
+        self._keepalive_task = None
+
+    async def _connect(self) -> aiosmtplib.SMTP:
+        """
+        Open and log in a new connection, trying each connection method in turn.
+        """
+        logger.info("[smtp] Connecting to %s:%s...", self.host, self.port)
+        last_error = None
+
+        for method, port in _connection_methods(self.port, self.use_ssl, self.use_tls):
+            smtp = aiosmtplib.SMTP(
+                hostname=self.host,
+                port=port,
+                use_tls=method == "ssl",
+                start_tls=self.use_tls if method == "starttls" else False,
+                timeout=30,
+            )
+            try:
+                await smtp.connect()
+                if self.user and self.password:
+                    await smtp.login(self.user, self.password)
+                logger.info("[smtp] Connected via %s on port %s", method.upper(), port)
+                return smtp
+            except Exception as e:
+                last_error = e
+                logger.warning("[smtp] Failed with %s on port %s: %s", method.upper(), port, e)
+                smtp.close()
+
+        raise Exception(f"Failed to connect to SMTP server after trying all methods. Last error: {last_error}")
+
+    async def fill(self):
+        """
+        Open connections up to the pool size and start the keepalive task.
+        """
+        while self._idle.qsize() < self.size:
+            self._idle.put_nowait(await self._connect())
+        self.start_keepalive()
+
+    def start_keepalive(self):
+        if self._keepalive_task is None or self._keepalive_task.done():
+            self._keepalive_task = asyncio.create_task(self._keepalive())
+
+    async def _keepalive(self):
+        while True:
+            await asyncio.sleep(KEEPALIVE_INTERVAL)
+            for _ in range(self._idle.qsize()):
+                try:
+                    smtp = self._idle.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                try:
+                    await smtp.noop()
+                except aiosmtplib.SMTPException:
+                    # Dead connection; its slot is reopened on next borrow
+                    smtp.close()
+                else:
+                    self._idle.put_nowait(smtp)
+
+    @asynccontextmanager
+    async def borrow(self):
+        """
+        Borrow a connection, returning it to the pool when done.
+
+        A connection the server dropped is discarded instead of returned.
+        """
+        async with self._slots:
+            self.start_keepalive()
+            try:
+                smtp = self._idle.get_nowait()
+            except asyncio.QueueEmpty:
+                smtp = await self._connect()
+
+            try:
+                yield smtp
+            except aiosmtplib.SMTPServerDisconnected:
+                smtp.close()
+                raise
+            except aiosmtplib.SMTPException:
+                # The server rejected this message; reset so the next one starts clean
+                try:
+                    await smtp.rset()
+                except aiosmtplib.SMTPException:
+                    smtp.close()
+                else:
+                    self._idle.put_nowait(smtp)
+                raise
+            except BaseException:
+                smtp.close()
+                raise
+            else:
+                self._idle.put_nowait(smtp)
+
+
+_pools: dict = {}
+
+
+def get_smtp_pool() -> SMTPPool:
+    """
+    Return the pool for the current SMTP settings, keyed by (host, port, auth).
     """
-    Send an email using SMTP with support for multiple connection methods.
-    
+    settings = _smtp_settings()
+    key = (settings["host"], settings["port"], settings["user"], settings["use_ssl"], settings["use_tls"])
+    pool = _pools.get(key)
+    if pool is None:
+        pool = SMTPPool(size=SMTP_POOL_SIZE, **settings)
+        _pools[key] = pool
+    return pool
+
+
+def _build_message(sender: str, to_email: str, subject: str, body: str) -> bytes:
+    """
+    Build and serialize an HTML email.
+    """
+    msg = MIMEMultipart('alternative')
+    msg['Subject'] = subject
+    msg['From'] = sender
+    msg['To'] = to_email
+
+    # Add HTML body
+    html_part = MIMEText(body, 'html')
+    msg.attach(html_part)
+
+    return msg.as_bytes()
+
+
+@lru_cache(maxsize=256)
+def _cached_message(sender: str, subject: str, body: str) -> bytes:
+    """
+    Serialized message with a placeholder recipient, built once per content.
+
+    Bulk and templated mail sends the same subject/body to many recipients,
+    so header encoding and MIME serialization only happen the first time.
+    """
+    return _build_message(sender, _TO_PLACEHOLDER.decode(), subject, body)
+
+
+def render_message(sender: str, to_email: str, subject: str, body: str) -> bytes:
+    """
+    Return the wire-format message for one recipient.
+    """
+    to_bytes = to_email.encode("utf-8")
+    if not _PLAIN_ADDRESS_RE.fullmatch(to_bytes):
+        # Needs header encoding; build it the slow way
+        return _build_message(sender, to_email, subject, body)
+
+    # Header lines can't start with "To: " inside a folded Subject, so the
+    # first full-line match is the To header itself
+    return _cached_message(sender, subject, body).replace(
+        _TO_HEADER, b"\nTo: " + to_bytes + b"\n", 1
+    )
+
+
+async def open_smtp_pool():
+    """
+    Pre-open the SMTP pool so the first emails don't pay for the handshake.
+    """
+    try:
+        await get_smtp_pool().fill()
+    except Exception as e:
+        # Not fatal: connections are opened on demand once the server is reachable
+        logger.warning("[smtp] Could not pre-open SMTP connections: %s", e)
+
+
+async def send_email(to_email: str, subject: str, body: str):
+    """
+    Send an email over a pooled SMTP connection.
+
     Supports:
     - Port 587 (STARTTLS) - Default
     - Port 465 (SSL/TLS) - Alternative
     - Port 25 (Standard SMTP) - Fallback
-    
+
     Args:
         to_email: Recipient email address
         subject: Email subject
         body: Email body (can be HTML)
-    
+
     Raises:
         Exception: If email fails to send
     """
-    # SMTP configuration
-    smtp_host = os.getenv("SMTP_HOST", "smtp.gmail.com")
-    smtp_port = int(os.getenv("SMTP_PORT", "587"))
-    smtp_user = os.getenv("SMTP_USER")
-    smtp_pass = os.getenv("SMTP_PASS")
     sender = os.getenv("EMAIL_SENDER", "noreply@example.com")
-    smtp_use_ssl = os.getenv("SMTP_USE_SSL", "false").lower() == "true"
-    smtp_use_tls = os.getenv("SMTP_USE_TLS", "true").lower() == "true"
-    
-    # Create email message
-    msg = MIMEMultipart('alternative')
-    msg['Subject'] = subject
-    msg['From'] = sender
-    msg['To'] = to_email
-    
-    # Add HTML body
-    html_part = MIMEText(body, 'html')
-    msg.attach(html_part)
+    message = render_message(sender, to_email, subject, body)
 
-    # Send email with fallback options
-    print(f"[smtp] Connecting to {smtp_host}:{smtp_port}...")
-    
-    # Try different connection methods based on port and configuration
-    connection_methods = []
-    
-    if smtp_port == 465 or smtp_use_ssl:
-        # Port 465 uses SSL/TLS from the start
-        connection_methods.append(("ssl", smtp_port))
-    elif smtp_port == 587:
-        # Port 587 uses STARTTLS
-        connection_methods.append(("starttls", 587))
-        # Fallback to SSL if STARTTLS fails
-        connection_methods.append(("ssl", 465))
-    else:
-        # Other ports (e.g., 25)
-        connection_methods.append(("starttls", smtp_port))
-        if smtp_use_tls:
-            connection_methods.append(("ssl", 465))
-    
-    last_error = None
-    
-    for method, port in connection_methods:
+    pool = get_smtp_pool()
+
+    # An idle connection may have been dropped since its last NOOP; retry once on a fresh one
+    for attempt in (1, 2):
         try:
-            print(f"[smtp] Trying {method.upper()} on port {port}...")
-            
-            if method == "ssl":
-                # Use SMTP_SSL for direct SSL/TLS connection
-                server = SMTP_SSL(smtp_host, port, timeout=30)
-            else:
-                # Use regular SMTP with STARTTLS
-                import socket
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.settimeout(30)
-                sock.connect((smtp_host, port))
-                
-                server = SMTP()
-                server.set_debuglevel(0)
-                server.sock = sock
-                
-                if smtp_use_tls:
-                    server.starttls()
-            
-            if smtp_user and smtp_pass:
-                print(f"[smtp] Logging in as {smtp_user}...")
-                server.login(smtp_user, smtp_pass)
-            
-            print(f"[smtp] Sending email to {to_email}...")
-            server.sendmail(sender, [to_email], msg.as_string())
-            print(f"[smtp] Email sent successfully via {method.upper()} on port {port}!")
-            server.quit()
-            return  # Success, exit function
-            
-        except Exception as e:
-            last_error = e
-            print(f"[smtp] Failed with {method.upper()} on port {port}: {e}")
-            continue
-    
-    # All methods failed
-    print(f"[smtp] All connection methods failed. Last error: {last_error}")
-    import traceback
-    traceback.print_exc()
-    raise Exception(f"Failed to send email after trying all methods. Last error: {last_error}")
\ No newline at end of file
+            async with pool.borrow() as smtp:
+                await smtp.sendmail(sender, [to_email], message)
+            break
+        except aiosmtplib.SMTPServerDisconnected as e:
+            if attempt == 2:
+                raise
+            logger.info("[smtp] Connection dropped (%s), reconnecting...", e)
+
+    logger.debug("[smtp] Email sent to %s", to_email)
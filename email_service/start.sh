@@ -1,6 +1,11 @@
 #!/bin/sh
+# Create tables and RabbitMQ queues once, before anything uses them
+python -c "from main import bootstrap; bootstrap()" || exit 1
+
 # Start worker in background, redirecting output to container's stdout/stderr
 python worker.py >> /proc/1/fd/1 2>> /proc/1/fd/2 &
 
-# Start API server (foreground)
-exec uvicorn main:app --host 0.0.0.0 --port 8000
+# Start API server (foreground), one process per CPU unless WEB_CONCURRENCY is set.
+exec uvicorn main:app --host 0.0.0.0 --port 8000 \
+    --loop uvloop --http httptools --no-access-log \
+    --workers "${WEB_CONCURRENCY:-$(nproc)}"
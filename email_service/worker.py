@@ -1,14 +1,23 @@
-import json
-import time
-import pika
-from datetime import datetime
-from uuid import uuid4
+import os
+import re
+import asyncio
+import logging
+import weakref
+from functools import lru_cache
+import aio_pika
 import pybreaker
+from cachetools import TTLCache
+from sqlalchemy import bindparam, insert, select, update
 
-from db import SessionLocal
-from models import EmailMessage, EmailStatus
-from services import send_email
-from task_queue import get_connection, QUEUE_NAME, publish_email_job
+from db import AsyncSessionLocal, warm_pool
+from models import EmailMessage, EmailStatus, utc_now, uuid7
+from services import send_email, open_smtp_pool, SMTP_POOL_SIZE
+from task_queue import (
+    get_async_connection, declare_topology, QUEUE_NAME, EXCHANGE_NAME,
+    MAX_RETRIES, BASE_DELAY, retry_queue_name, encode_job, decode_job,
+)
+
+logger = logging.getLogger(__name__)
 
 # Circuit breaker configuration
 breaker = pybreaker.CircuitBreaker(
@@ -16,180 +25,455 @@ breaker = pybreaker.CircuitBreaker(
     reset_timeout=30      # seconds before trying again
 )
 
-# Retry configuration
-MAX_RETRIES = 5
-BASE_DELAY = 2  # seconds for exponential backoff
+# Unacked messages the broker may hand us at once; each is processed concurrently.
+# Keep PREFETCH_COUNT / SMTP_POOL_SIZE x send time well under the broker's
+# consumer ack timeout.
+PREFETCH_COUNT = int(os.getenv("PREFETCH_COUNT", "50"))
 
+# Emails being claimed and sent at once. Deliveries beyond this wait here, before
+# the claim, so they hold neither a row lock nor a database connection while an
+# SMTP connection is busy. One per pooled SMTP connection.
+_send_slots = asyncio.Semaphore(SMTP_POOL_SIZE)
 
-def process_email(email_id: str, retry_count: int = 0):
-    db = SessionLocal()
-    try:
-        email = db.query(EmailMessage).filter(EmailMessage.id == email_id).first()
-        if not email:
-            print(f"[worker] Email {email_id} not found")
-            return
+# Finished deliveries are acked together once this many are waiting, or after
+# ACK_BATCH_DELAY seconds, whichever comes first
+ACK_BATCH_SIZE = int(os.getenv("ACK_BATCH_SIZE", "32"))
+ACK_BATCH_DELAY = float(os.getenv("ACK_BATCH_DELAY_MS", "200")) / 1000
+
+# Emails this worker sent recently. Redeliveries of them are dropped without
+# touching the database; anything not in here still gets the database check.
+_recently_sent = TTLCache(maxsize=10000, ttl=300)
+
+# Gateway emails are inserted in batches of up to INSERT_BATCH_SIZE rows, waiting
+# at most INSERT_BATCH_DELAY seconds for a batch to fill
+INSERT_BATCH_SIZE = int(os.getenv("INSERT_BATCH_SIZE", "32"))
+INSERT_BATCH_DELAY = float(os.getenv("INSERT_BATCH_DELAY_MS", "5")) / 1000
+
+# Channel the worker consumes on, also used to publish retries
+_channel = None
+
+# Batch flushes in flight. The event loop only keeps weak references to tasks,
+# so they are held here until done.
+_flush_tasks = set()
+
+# Hot-path statements, built once and reused with per-message parameters
+_emails = EmailMessage.__table__
+
+# Rows already being sent are locked by their claim; skip them rather than wait
+_claimable = (
+    select(_emails.c.id)
+    .where(_emails.c.id == bindparam("email_id"), _emails.c.status != EmailStatus.sent)
+    .with_for_update(skip_locked=True)
+    .scalar_subquery()
+)
+
+_CLAIM_EMAIL = (
+    update(_emails)
+    .where(_emails.c.id == _claimable)
+    .values(status=EmailStatus.processing)
+    .returning(_emails.c.to_email, _emails.c.subject, _emails.c.body, _emails.c.priority)
+)
+
+# The SET clause comes from the parameters passed at execution
+_UPDATE_EMAIL = update(_emails).where(_emails.c.id == bindparam("email_id"))
+
+# sent_at is stamped by Postgres when the status is written
+_MARK_SENT = _UPDATE_EMAIL.values(status=EmailStatus.sent, sent_at=utc_now())
+
+_INSERT_EMAIL = insert(_emails)
+
+# Template placeholders, e.g. {{name}}
+_PLACEHOLDER_RE = re.compile(r"\{\{([^{}]+)\}\}")
+
+
+@lru_cache(maxsize=512)
+def _compile_template(text: str) -> tuple:
+    """
+    Split a template into alternating literal text and placeholder names.
+
+    Messages using the same template share the result, so each template
+    is only scanned for placeholders once.
+    """
+    return tuple(_PLACEHOLDER_RE.split(text))
+
+
+def render_template(text: str, values: dict) -> str:
+    """
+    Fill in {{name}} placeholders; names missing from values are left as-is.
+    """
+    parts = _compile_template(text)
+    if len(parts) == 1:
+        return text
+
+    rendered = list(parts)
+    for i in range(1, len(parts), 2):
+        name = parts[i]
+        rendered[i] = values[name] if name in values else f"{{{{{name}}}}}"
+    return "".join(rendered)
+
+
+async def _set_status(db, email_id, statement=_UPDATE_EMAIL, **values):
+    await db.execute(statement, {"email_id": email_id, **values})
+    await db.commit()
 
-        if email.status == EmailStatus.sent:
-            print(f"[worker] Email {email_id} already sent, skipping")
+
+async def schedule_retry(email_id: str, retry_count: int, priority: int = 0):
+    """
+    Park a retry in its delay queue; RabbitMQ routes it back to the email
+    queue once the delay has passed, so the worker never waits for it.
+    The priority travels with the message and applies again on return.
+
+    Returns once the broker has confirmed the message. Concurrent retries
+    share the channel, so their confirms are pipelined rather than serialized.
+    """
+    body, content_type = encode_job({
+        "email_id": str(email_id),
+        "retry_count": retry_count
+    })
+    await _channel.default_exchange.publish(
+        aio_pika.Message(
+            body,
+            content_type=content_type,
+            delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+            priority=priority,
+        ),
+        routing_key=retry_queue_name(retry_count),
+        mandatory=True,
+    )
+
+
+async def process_email(email_id: str, retry_count: int = 0):
+    """
+    Send one email and record the outcome.
+    """
+    email_id = str(email_id)
+    if email_id in _recently_sent:
+        logger.info("[worker] Email %s already sent, skipping", email_id)
+        return
+
+    async with _send_slots, AsyncSessionLocal() as db:
+        # Claim the email and fetch what we need to send it in one round-trip;
+        # missing, already-sent and in-flight emails match no row. The claim stays
+        # uncommitted until the final status is written, so each email costs one
+        # commit: a duplicate delivery skips the locked row instead of sending it
+        # twice, and a crash mid-send rolls the email back to queued.
+        result = await db.execute(_CLAIM_EMAIL, {"email_id": email_id})
+        email = result.first()
+
+        if email is None:
+            logger.info("[worker] Email %s not found, already sent or being sent, skipping", email_id)
             return
 
-        email.status = EmailStatus.processing
-        db.commit()
-        print(f"[worker] Processing email {email_id} to {email.to_email}")
+        logger.debug("[worker] Processing email %s to %s", email_id, email.to_email)
+        retry = False
 
         try:
-            # Circuit breaker wraps the send_email function
-            breaker.call(send_email, email.to_email, email.subject, email.body)
+            # Circuit breaker wraps the send
+            with breaker.calling():
+                await send_email(email.to_email, email.subject, email.body)
 
-            email.status = EmailStatus.sent
-            email.sent_at = datetime.utcnow()
-            db.commit()
-            print(f"[worker] ✓ Email {email_id} sent successfully!")
+            statement, values = _MARK_SENT, {}
+            logger.debug("[worker] ✓ Email %s sent successfully!", email_id)
 
         except pybreaker.CircuitBreakerError:
             # Circuit is OPEN, skip sending
-            print(f"[worker] Circuit breaker OPEN, skipping email {email_id}")
-            email.status = EmailStatus.failed
-            email.error_message = "Circuit breaker open"
-            db.commit()
+            logger.warning("[worker] Circuit breaker OPEN, skipping email %s", email_id)
+            statement, values = _UPDATE_EMAIL, {"status": EmailStatus.failed, "error_message": "Circuit breaker open"}
 
         except Exception as e:
             # Failed sending email
-            print(f"[worker] ✗ Email {email_id} failed: {e}")
+            logger.warning("[worker] ✗ Email %s failed: %s", email_id, e)
             if retry_count < MAX_RETRIES:
                 # exponential backoff before retry
                 delay = BASE_DELAY ** retry_count
-                print(f"[worker] Retrying in {delay}s (retry {retry_count + 1})")
-                time.sleep(delay)
-                
-                # Requeue the email with incremented retry count
-                publish_email_job({
-                    "email_id": str(email.id),
-                    "retry_count": retry_count + 1
-                })
-
-                email.status = EmailStatus.queued
-                db.commit()
+                logger.info("[worker] Retrying in %ss (retry %s)", delay, retry_count + 1)
+                retry = True
             else:
-                email.status = EmailStatus.failed
-                email.error_message = str(e)
-                db.commit()
-                print(f"[worker] Email {email_id} failed after {MAX_RETRIES} retries")
+                statement, values = _UPDATE_EMAIL, {"status": EmailStatus.failed, "error_message": str(e)}
+                logger.error("[worker] Email %s failed after %s retries", email_id, MAX_RETRIES)
+
+        if not retry:
+            await _set_status(db, email_id, statement, **values)
+            if statement is _MARK_SENT:
+                _recently_sent[email_id] = True
+            return
+
+        # Dropping the uncommitted claim leaves the email queued without writing
+        # anything, and releases the row before the retry can come back for it
+        await db.rollback()
+        try:
+            await schedule_retry(email_id, retry_count + 1, email.priority)
+        except Exception as e:
+            # Not confirmed or unroutable: nothing will bring this email back
+            logger.error("[worker] Could not schedule retry for email %s: %s", email_id, e)
+            await _set_status(db, email_id, status=EmailStatus.failed, error_message=f"Retry not scheduled: {e}")
+
+
+def _spawn(coro):
+    task = asyncio.ensure_future(coro)
+    _flush_tasks.add(task)
+    task.add_done_callback(_flush_tasks.discard)
 
-    finally:
-        db.close()
 
+def _resolve(future: asyncio.Future, error: Exception = None):
+    """
+    Complete a waiter unless it was cancelled in the meantime.
+    """
+    if future.done():
+        return
+    if error is None:
+        future.set_result(None)
+    else:
+        future.set_exception(error)
+
+
+class InsertBatcher:
+    """
+    Write gateway emails arriving from concurrent deliveries with one
+    multi-row INSERT and one commit.
+
+    If the batch fails, its rows are retried one at a time, so a single bad
+    message only fails its own insert.
+    """
+
+    def __init__(self):
+        self._pending = []  # (row, future)
+        self._flush_handle = None
+
+    async def insert(self, row: dict):
+        """
+        Queue a row and wait until it is committed.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((row, future))
+        if len(self._pending) >= INSERT_BATCH_SIZE:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(INSERT_BATCH_DELAY, self._flush)
+        await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            _spawn(self._write(batch))
+
+    async def _write(self, batch):
+        async with AsyncSessionLocal() as db:
+            try:
+                await db.execute(_INSERT_EMAIL, [row for row, _ in batch])
+                await db.commit()
+            except Exception as e:
+                await db.rollback()
+                if len(batch) == 1:
+                    _resolve(batch[0][1], e)
+                    return
+            else:
+                for _, future in batch:
+                    _resolve(future)
+                return
+
+            for row, future in batch:
+                try:
+                    await db.execute(_INSERT_EMAIL, row)
+                    await db.commit()
+                except Exception as e:
+                    await db.rollback()
+                    _resolve(future, e)
+                else:
+                    _resolve(future)
 
-def callback(ch, method, properties, body):
+
+_email_inserts = InsertBatcher()
+
+
+async def handle_gateway_message(message: dict):
+    """
+    Handle an API Gateway message: {notification_id, user_id, email, name, template, ...}
+    """
+    notification_id = message.get("notification_id")
+    user_id = message.get("user_id")
+    email = message.get("email")
+    template = message.get("template", {})
+
+    if not email or not template:
+        logger.warning("[worker] Invalid API Gateway message format: missing email or template")
+        return
+
+    # Extract subject and body from template
+    subject = template.get("subject", "Notification")
+    # Template service returns 'html_body', not 'body'
+    body_content = template.get("html_body") or template.get("body", "You have a new notification")
+
+    # Get template variables and data for substitution
+    template_variables = template.get("variables", [])
+    notification_data = message.get("data", {})
+
+    # Substitute template variables (e.g., {{name}} -> actual value)
+    if template_variables and notification_data:
+        values = {name: str(notification_data.get(name, "")) for name in template_variables}
+        body_content = render_template(body_content, values)
+        subject = render_template(subject, values)
+
+    logger.debug("[worker] Received API Gateway notification: %s for user: %s", notification_id, user_id)
+    logger.debug("[worker] Template: %s, Subject: %s", template.get("name", "unknown"), subject)
+
+    # Create the email record (batched with other deliveries), then send it
+    email_id = uuid7()
     try:
-        message = json.loads(body)
-        
+        await _email_inserts.insert({
+            "id": email_id,
+            "user_id": user_id,
+            "to_email": email,
+            "subject": subject,
+            "body": body_content,
+            "status": EmailStatus.queued
+        })
+        logger.debug("[worker] Created email record: %s", email_id)
+
+    except Exception as e:
+        logger.error("[worker] Error creating email record: %s", e)
+        return
+
+    # Process the email
+    await process_email(str(email_id), retry_count=0)
+
+
+class AckBatcher:
+    """
+    Acknowledge finished deliveries of one channel in bulk.
+
+    Deliveries finish out of order, so a multiple=True ack can only cover an
+    unbroken run of finished delivery tags following the last one acked.
+    Anything that finished past a delivery still in progress is acked on its
+    own at flush time, so one slow email never holds prefetch slots.
+    """
+
+    def __init__(self):
+        self._acked_upto = 0   # every tag up to here is acked
+        self._acked_ahead = set()  # tags above _acked_upto acked individually
+        self._finished = {}    # delivery tag -> finished, unacked message
+        self._flush_handle = None
+
+    def finish(self, message: aio_pika.abc.AbstractIncomingMessage):
+        self._finished[message.delivery_tag] = message
+        if len(self._finished) >= ACK_BATCH_SIZE:
+            self._schedule_flush(0)
+        elif self._flush_handle is None:
+            self._schedule_flush(ACK_BATCH_DELAY)
+
+    def _schedule_flush(self, delay: float):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        loop = asyncio.get_running_loop()
+        self._flush_handle = loop.call_later(delay, lambda: _spawn(self.flush()))
+
+    async def flush(self):
+        self._flush_handle = None
+
+        # Walk the unbroken run of finished tags; ack its last finished message
+        last = None
+        tag = self._acked_upto + 1
+        while tag in self._finished or tag in self._acked_ahead:
+            if tag in self._finished:
+                last = self._finished.pop(tag)
+            self._acked_ahead.discard(tag)
+            tag += 1
+        self._acked_upto = tag - 1
+
+        stragglers, self._finished = self._finished, {}
+        self._acked_ahead.update(stragglers)
+
+        try:
+            if last is not None:
+                await last.ack(multiple=True)
+            for message in stragglers.values():
+                await message.ack()
+        except Exception as e:
+            # Channel is gone; the broker redelivers whatever was left unacked
+            logger.warning("[worker] Could not acknowledge messages: %s", e)
+
+
+# One batcher per channel: delivery tags restart when a channel is reopened
+_ack_batchers: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+def _finish(message: aio_pika.abc.AbstractIncomingMessage):
+    """
+    Hand a processed delivery to its channel's AckBatcher.
+    """
+    try:
+        channel = message.channel
+    except aio_pika.exceptions.ChannelInvalidStateError:
+        return  # Channel closed; the message will be redelivered
+
+    batcher = _ack_batchers.get(channel)
+    if batcher is None:
+        batcher = _ack_batchers[channel] = AckBatcher()
+    batcher.finish(message)
+
+
+async def on_message(message: aio_pika.abc.AbstractIncomingMessage):
+    """
+    Handle one delivery. aio-pika runs each delivery in its own task, so up
+    to PREFETCH_COUNT emails are in flight; finished ones are acked in batches.
+    """
+    try:
+        payload = decode_job(message.body, message.content_type)
+
         # Check if this is an API Gateway message or internal retry message
-        if "email_id" in message:
+        if "email_id" in payload:
             # Internal retry message format
-            email_id = message["email_id"]
-            retry_count = message.get("retry_count", 0)
+            email_id = payload["email_id"]
+            retry_count = payload.get("retry_count", 0)
 
-            print(f"\n[worker] Received email job: {email_id} (retry {retry_count})")
-            process_email(email_id, retry_count=retry_count)
+            logger.debug("[worker] Received email job: %s (retry %s)", email_id, retry_count)
+            await process_email(email_id, retry_count=retry_count)
         else:
-            # API Gateway message format: {notification_id, user_id, email, name, template, ...}
-            notification_id = message.get("notification_id")
-            user_id = message.get("user_id")
-            email = message.get("email")
-            template = message.get("template", {})
-            
-            if not email or not template:
-                print(f"[worker] Invalid API Gateway message format: missing email or template")
-                ch.basic_ack(delivery_tag=method.delivery_tag)
-                return
-            
-            # Extract subject and body from template
-            subject = template.get("subject", "Notification")
-            # Template service returns 'html_body', not 'body'
-            body_content = template.get("html_body") or template.get("body", "You have a new notification")
-            
-            # Get template variables and data for substitution
-            template_variables = template.get("variables", [])
-            notification_data = message.get("data", {})
-            
-            # Substitute template variables (e.g., {{name}} -> actual value)
-            if template_variables and notification_data:
-                for var_name in template_variables:
-                    placeholder = f"{{{{{var_name}}}}}"
-                    value = notification_data.get(var_name, "")
-                    body_content = body_content.replace(placeholder, str(value))
-                    subject = subject.replace(placeholder, str(value))
-            
-            print(f"\n[worker] Received API Gateway notification: {notification_id} for user: {user_id}")
-            print(f"[worker] Template: {template.get('name', 'unknown')}, Subject: {subject}")
-            
-            # Create email record in database
-            db = SessionLocal()
-            try:
-                new_email = EmailMessage(
-                    id=uuid4(),
-                    user_id=user_id,
-                    to_email=email,
-                    subject=subject,
-                    body=body_content,
-                    status=EmailStatus.queued,
-                    created_at=datetime.utcnow()
-                )
-                
-                db.add(new_email)
-                db.commit()
-                db.refresh(new_email)
-                
-                print(f"[worker] Created email record: {new_email.id}")
-                
-                # Process the email
-                process_email(str(new_email.id), retry_count=0)
-                
-            except Exception as e:
-                print(f"[worker] Error creating email record: {e}")
-                db.rollback()
-            finally:
-                db.close()
-
-        ch.basic_ack(delivery_tag=method.delivery_tag)
-        print(f"[worker] Message acknowledged\n")
+            await handle_gateway_message(payload)
 
     except Exception as e:
-        print(f"[worker] Error processing message: {e}")
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+        logger.error("[worker] Error processing message: %s", e)
 
+    _finish(message)
 
-def start_worker():
-    print("=" * 50)
-    print("EMAIL WORKER STARTING")
-    print("=" * 50)
-
-    connection = get_connection()
-    channel = connection.channel()
-    
-    # Declare exchange
-    channel.exchange_declare(exchange="notifications.direct", exchange_type="direct", durable=True)
-    
-    # Declare queue
-    channel.queue_declare(queue=QUEUE_NAME, durable=True)
-    
-    # Bind queue to exchange with routing key "email"
-    channel.queue_bind(exchange="notifications.direct", queue=QUEUE_NAME, routing_key="email")
-    
-    channel.basic_qos(prefetch_count=1)
-    channel.basic_consume(queue=QUEUE_NAME, on_message_callback=callback)
-
-    print(f"[worker] Listening to queue: {QUEUE_NAME} (from notifications.direct exchange)")
-    print("[worker] Waiting for emails... Press CTRL+C to exit\n")
 
+async def run_worker():
+    global _channel
+
+    logger.info("[worker] Email worker starting")
+
+    await asyncio.gather(open_smtp_pool(), warm_pool())
+
+    connection = await get_async_connection()
+    async with connection:
+        # Retries are confirmed by the broker; an unroutable one raises instead of vanishing
+        channel = _channel = await connection.channel(on_return_raises=True)
+        await channel.set_qos(prefetch_count=PREFETCH_COUNT)
+
+        # Same exchange, queues and arguments the API publishes against.
+        # The robust channel re-declares them by itself after a reconnect.
+        queue = await declare_topology(channel)
+
+        await queue.consume(on_message)
+
+        logger.info("[worker] Listening to queue: %s (from %s exchange)", QUEUE_NAME, EXCHANGE_NAME)
+        logger.info("[worker] Waiting for emails... Press CTRL+C to exit")
+
+        await asyncio.Future()
+
+
+def start_worker():
+    logging.basicConfig(
+        level=os.getenv("LOG_LEVEL", "INFO").upper(),
+        format="%(asctime)s %(levelname)s %(message)s",
+    )
     try:
-        channel.start_consuming()
+        asyncio.run(run_worker())
     except KeyboardInterrupt:
-        print("\n[worker] Shutting down...")
-        channel.stop_consuming()
-    finally:
-        connection.close()
+        logger.info("[worker] Shutting down...")
 
 
 if __name__ == "__main__":